@@ -1,8 +1,11 @@
 # app/ai/nlp_processor.py
+import functools
+import re
+import threading
 import spacy
 import pandas as pd
 from transformers import pipeline
-from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
 from sklearn.preprocessing import StandardScaler
 import numpy as np
 from datetime import datetime, timedelta
@@ -14,17 +17,119 @@ import os
 import joblib
 from app.models import Expense, Category, User
 
-# Load NLP models
-try:
-    nlp = spacy.load("en_core_web_md")
-except:
-    # Download if not available
-    import spacy.cli
-    spacy.cli.download("en_core_web_md")
-    nlp = spacy.load("en_core_web_md")
+# The spaCy model carries ~300-500 MB of vectors, so don't pay for it at
+# import time in every worker. get_nlp() loads it on first use; calling it
+# from a pre-fork server hook (gunicorn when_ready/post_fork) lets forked
+# workers share the vector pages copy-on-write.
+_nlp = None
+_nlp_lock = threading.Lock()
 
-# Initialize Hugging Face transformers
-zero_shot_classifier = pipeline("zero-shot-classification")
+def get_nlp():
+    """Return the shared spaCy pipeline, loading it on first use"""
+    global _nlp
+    if _nlp is None:
+        with _nlp_lock:
+            if _nlp is None:
+                try:
+                    _nlp = spacy.load("en_core_web_md")
+                except:
+                    # Download if not available
+                    import spacy.cli
+                    spacy.cli.download("en_core_web_md")
+                    _nlp = spacy.load("en_core_web_md")
+    return _nlp
+
+# One-time ONNX exports (optimum-cli export onnx --model <name> --optimize O3 <dir>)
+# picked up automatically when running on CPU - ONNX Runtime fuses the
+# attention/LayerNorm/GELU kernels the PyTorch CPU path lacks
+ZERO_SHOT_ONNX_PATH = "models/zero_shot_onnx"
+NER_ONNX_PATH = "models/ner_onnx"
+
+def _load_zero_shot_classifier():
+    """Load the zero-shot classifier, preferring the ONNX export on CPU.
+
+    The ONNX path is tried first so CPU deployments with an export never
+    construct (and immediately discard) the full PyTorch model at worker
+    start. The distilled MNLI model used as the fallback halves the FLOPs
+    of the default bart-large-mnli with minimal accuracy loss.
+    """
+    if not torch.cuda.is_available() and os.path.isdir(ZERO_SHOT_ONNX_PATH):
+        try:
+            from optimum.onnxruntime import ORTModelForSequenceClassification
+            from transformers import AutoTokenizer
+
+            return pipeline(
+                "zero-shot-classification",
+                model=ORTModelForSequenceClassification.from_pretrained(
+                    ZERO_SHOT_ONNX_PATH, provider="CPUExecutionProvider"
+                ),
+                tokenizer=AutoTokenizer.from_pretrained(ZERO_SHOT_ONNX_PATH)
+            )
+        except Exception as e:
+            print(f"Error loading ONNX zero-shot model, falling back to PyTorch: {e}")
+
+    return pipeline("zero-shot-classification", model="valhalla/distilbart-mnli-12-1")
+
+zero_shot_classifier = _load_zero_shot_classifier()
+
+# Common expense categories used for zero-shot fallback classification
+COMMON_CATEGORIES = [
+    "Food & Dining", "Groceries", "Shopping", "Transportation",
+    "Entertainment", "Bills & Utilities", "Health", "Travel",
+    "Education", "Personal Care", "Home", "Gifts", "Business"
+]
+
+# Components each processing path can skip - running the full
+# tagger/parser/NER pipeline on every call roughly doubles the cost
+LEMMA_DISABLED = ["parser", "ner"]
+VECTOR_DISABLED = ["tok2vec", "tagger", "parser", "ner", "lemmatizer", "attribute_ruler"]
+NER_DISABLED = ["tagger", "parser", "lemmatizer", "attribute_ruler"]
+
+# Pre-compiled patterns for email scanning - one regex pass instead of a
+# per-token Python loop, and one alternation instead of four separate scans
+_MONEY_RE = re.compile(r'\$\s*([\d,]+(?:\.\d+)?)')
+_ORDER_RE = re.compile(
+    r'(?:order|confirmation|transaction|receipt)\s+(?:number|#)?:\s*([A-Za-z0-9\-]+)',
+    re.IGNORECASE
+)
+_SUBJECT_MERCHANT_RES = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r'(?:Receipt|Order|Confirmation) from ([\w\s&]+)',
+    r'([\w\s&]+) Order Confirmation',
+    r'Your ([\w\s&]+) order',
+    r'Thanks for your ([\w\s&]+) order'
+))
+
+def nlp_lemma(text):
+    """Process text with only the components needed for lemmatization"""
+    nlp = get_nlp()
+    with nlp.select_pipes(disable=LEMMA_DISABLED):
+        return nlp(text)
+
+def nlp_vec(text):
+    """Process text for its vector only - static vectors need no components"""
+    nlp = get_nlp()
+    with nlp.select_pipes(disable=VECTOR_DISABLED):
+        return nlp(text)
+
+def nlp_ner(text):
+    """Process text with only the NER component"""
+    nlp = get_nlp()
+    with nlp.select_pipes(disable=NER_DISABLED):
+        return nlp(text)
+
+# Memoized NLP helpers - merchant/description strings repeat constantly
+# across expenses, so a cache hit replaces a pipeline pass with a dict lookup
+
+@functools.lru_cache(maxsize=10000)
+def _preprocess_text_cached(text):
+    """Lemmatize and strip stopwords/punctuation, cached per raw text"""
+    doc = nlp_lemma(text.lower())
+    return " ".join(token.lemma_ for token in doc if not token.is_stop and not token.is_punct)
+
+@functools.lru_cache(maxsize=10000)
+def _vector_for_text(text):
+    """spaCy vector for a preprocessed text, cached per text"""
+    return nlp_vec(text).vector
 
 class ExpenseNLPProcessor:
     """Advanced NLP processor for expense categorization"""
@@ -39,11 +144,10 @@ class ExpenseNLPProcessor:
     def load_or_create_model(self):
         """Load model if exists, otherwise create a placeholder"""
         if os.path.exists(self.model_path):
-            with open(self.model_path, 'rb') as f:
-                model_data = pickle.load(f)
-                self.model = model_data.get('model')
-                self.vectorizer = model_data.get('vectorizer')
-                self.categories = model_data.get('categories')
+            model_data = joblib.load(self.model_path)
+            self.model = model_data.get('model')
+            self.vectorizer = model_data.get('vectorizer')
+            self.categories = model_data.get('categories')
         else:
             # We'll train the model when we have data
             self.model = None
@@ -52,19 +156,23 @@ class ExpenseNLPProcessor:
         """Preprocess text for NLP analysis"""
         if not text:
             return ""
-        
-        # Process with spaCy
-        doc = nlp(text.lower())
-        
-        # Remove stopwords and punctuation, lemmatize
-        tokens = [token.lemma_ for token in doc if not token.is_stop and not token.is_punct]
-        
-        return " ".join(tokens)
-    
+
+        return _preprocess_text_cached(text)
+
+    def preprocess_texts(self, texts):
+        """Preprocess a batch of texts with a single spaCy pipe pass"""
+        processed = []
+        for doc in get_nlp().pipe((text.lower() if text else "" for text in texts), batch_size=256,
+                                  disable=LEMMA_DISABLED):
+            tokens = [token.lemma_ for token in doc if not token.is_stop and not token.is_punct]
+            processed.append(" ".join(tokens))
+
+        return processed
+
     def extract_features(self, expense_text):
         """Extract NLP features from expense text"""
         # Process with spaCy
-        doc = nlp(expense_text)
+        doc = get_nlp()(expense_text)
         
         # Extract entities (companies, products, amounts)
         entities = [(ent.text, ent.label_) for ent in doc.ents]
@@ -88,47 +196,51 @@ class ExpenseNLPProcessor:
             return False
 
         # Extract text data and categories
-        texts = []
+        raw_texts = []
         labels = []
         categories = set()
-        
+
         for expense in expenses:
-            combined_text = f"{expense.merchant} {expense.description if expense.description else ''}"
-            text = self.preprocess_text(combined_text)
-            
             if expense.category and expense.category.name:
-                texts.append(text)
+                combined_text = f"{expense.merchant} {expense.description if expense.description else ''}"
+                raw_texts.append(combined_text)
                 labels.append(expense.category.name)
                 categories.add(expense.category.name)
-        
-        if not texts:
+
+        if not raw_texts:
             return False
-        
+
+        # Preprocess all texts in one batched spaCy pass
+        texts = self.preprocess_texts(raw_texts)
+
         # Convert to DataFrame for easier processing
         df = pd.DataFrame({'text': texts, 'category': labels})
-        
-        # Use spaCy for vectorization
-        vectors = [nlp(text).vector for text in df['text']]
-        
+
         # Use scikit-learn for classification
-        from sklearn.ensemble import RandomForestClassifier
+        from sklearn.ensemble import HistGradientBoostingClassifier
         from sklearn.model_selection import train_test_split
-        
-        X = np.array(vectors)
+
+        # Vectorize into a pre-allocated float32 matrix - filling rows straight
+        # from the pipe avoids materializing N separate ndarrays and then
+        # copying (and upcasting) them in np.array
+        nlp = get_nlp()
+        X = np.empty((len(df), nlp.vocab.vectors_length), dtype=np.float32)
+        for i, doc in enumerate(nlp.pipe(df['text'], batch_size=256, disable=VECTOR_DISABLED)):
+            X[i] = doc.vector
         y = df['category'].values
-        
-        # Train model
-        model = RandomForestClassifier(n_estimators=100, random_state=42)
+
+        # Train model - histogram-based trees bin features to uint8, giving a
+        # much smaller pickled model and faster predict than a random forest
+        model = HistGradientBoostingClassifier(max_bins=255, max_iter=200, random_state=42)
         model.fit(X, y)
-        
-        # Save the model
+
+        # Save the model (compressed - cuts load time on process start)
         os.makedirs(os.path.dirname(self.model_path), exist_ok=True)
-        with open(self.model_path, 'wb') as f:
-            pickle.dump({
-                'model': model,
-                'vectorizer': None,  # We're using spaCy directly
-                'categories': list(categories)
-            }, f)
+        joblib.dump({
+            'model': model,
+            'vectorizer': None,  # We're using spaCy directly
+            'categories': list(categories)
+        }, self.model_path, compress=3)
         
         self.model = model
         self.categories = list(categories)
@@ -142,51 +254,78 @@ class ExpenseNLPProcessor:
         
         combined_text = f"{expense.merchant} {expense.description if expense.description else ''}"
         text = self.preprocess_text(combined_text)
-        vector = nlp(text).vector
+        vector = _vector_for_text(text)
         
         # Predict using trained model
         prediction = self.model.predict([vector])[0]
-        
+
         return prediction
-    
+
+    def predict_categories(self, expenses):
+        """Predict categories for a batch of expenses in one model call"""
+        if not expenses:
+            return []
+
+        if not self.model:
+            return self.zero_shot_classification_batch(expenses)
+
+        texts = self.preprocess_texts(
+            [f"{e.merchant} {e.description if e.description else ''}" for e in expenses]
+        )
+
+        # One feature matrix and one predict call - sklearn's per-call
+        # overhead is flat, so batching amortizes it across all expenses
+        nlp = get_nlp()
+        X = np.empty((len(texts), nlp.vocab.vectors_length), dtype=np.float32)
+        for i, doc in enumerate(nlp.pipe(texts, batch_size=256, disable=VECTOR_DISABLED)):
+            X[i] = doc.vector
+
+        return self.model.predict(X).tolist()
+
     def zero_shot_classification(self, expense):
         """Fallback to zero-shot classification if no model is trained"""
-        # Define common expense categories
-        common_categories = [
-            "Food & Dining", "Groceries", "Shopping", "Transportation", 
-            "Entertainment", "Bills & Utilities", "Health", "Travel", 
-            "Education", "Personal Care", "Home", "Gifts", "Business"
-        ]
-        
         # Extract text data
         combined_text = f"{expense.merchant} {expense.description if expense.description else ''}"
-        
+
         # Use zero-shot classification
         result = zero_shot_classifier(
             combined_text,
-            candidate_labels=common_categories,
+            candidate_labels=COMMON_CATEGORIES,
         )
-        
+
         # Return the most likely category
         return result['labels'][0]
+
+    def zero_shot_classification_batch(self, expenses):
+        """Zero-shot classify many expenses in one batched pipeline call"""
+        texts = [f"{e.merchant} {e.description if e.description else ''}" for e in expenses]
+
+        # One call amortizes the premise encoding across all expenses
+        results = zero_shot_classifier(
+            texts,
+            candidate_labels=COMMON_CATEGORIES,
+            batch_size=32,
+            multi_label=False
+        )
+
+        # Pipeline returns a single dict for a single input
+        if isinstance(results, dict):
+            results = [results]
+
+        return [result['labels'][0] for result in results]
     
     def extract_email_info(self, email_text):
         """Extract expense information from email text using NLP"""
-        doc = nlp(email_text)
+        doc = nlp_ner(email_text)
         
-        # Extract amounts (money)
+        # Extract amounts (money) with a single regex pass
         amounts = []
-        for token in doc:
-            if token.like_num and token.i > 0:
-                prev_token = doc[token.i - 1]
-                if prev_token.text == '$' or prev_token.text.startswith('$'):
-                    amount = token.text
-                    try:
-                        amount_float = float(amount.replace(',', ''))
-                        amounts.append(amount_float)
-                    except ValueError:
-                        pass
-        
+        for match in _MONEY_RE.findall(email_text):
+            try:
+                amounts.append(float(match.replace(',', '')))
+            except ValueError:
+                pass
+
         # Use entities for organization (merchant) detection
         organizations = [ent.text for ent in doc.ents if ent.label_ == "ORG"]
         
@@ -194,19 +333,8 @@ class ExpenseNLPProcessor:
         dates = [ent.text for ent in doc.ents if ent.label_ == "DATE"]
         
         # Extract order or transaction numbers
-        import re
-        order_patterns = [
-            r'order\s+(?:number|#)?:\s*([A-Za-z0-9\-]+)',
-            r'confirmation\s+(?:number|#)?:\s*([A-Za-z0-9\-]+)',
-            r'transaction\s+(?:number|#)?:\s*([A-Za-z0-9\-]+)',
-            r'receipt\s+(?:number|#)?:\s*([A-Za-z0-9\-]+)'
-        ]
-        
-        order_numbers = []
-        for pattern in order_patterns:
-            matches = re.findall(pattern, email_text, re.IGNORECASE)
-            order_numbers.extend(matches)
-        
+        order_numbers = _ORDER_RE.findall(email_text)
+
         return {
             "amounts": amounts,
             "merchants": organizations,
@@ -234,17 +362,15 @@ class ExpensePredictor:
     
     def prepare_data(self, expenses):
         """Prepare expense data for Prophet"""
-        # Convert expenses to DataFrame
-        data = []
-        for expense in expenses:
-            data.append({
-                'ds': expense.date,
-                'y': expense.amount,
-                'category': expense.category.name if expense.category else 'Uncategorized',
-                'merchant': expense.merchant
-            })
-        
-        df = pd.DataFrame(data)
+        # Convert expenses to DataFrame columnar-style - a dict of column
+        # lists skips the per-row dict allocation and dtype re-inference
+        # that a list-of-dicts construction pays
+        df = pd.DataFrame({
+            'ds': [e.date for e in expenses],
+            'y': [e.amount for e in expenses],
+            'category': [e.category.name if e.category else 'Uncategorized' for e in expenses],
+            'merchant': [e.merchant for e in expenses]
+        })
         
         # Aggregate by day
         daily_df = df.groupby('ds')['y'].sum().reset_index()
@@ -258,13 +384,19 @@ class ExpensePredictor:
         
         # Prepare data
         df = self.prepare_data(expenses)
-        
-        # Initialize and train model
+
+        # Initialize and train model - cmdstanpy backend fits much faster than
+        # pystan, yearly harmonics are pointless on under a year of data, and
+        # 100 uncertainty samples are plenty for the yhat_lower/upper bounds
+        span_days = (df['ds'].max() - df['ds'].min()).days
+
         model = Prophet(
-            yearly_seasonality=True,
+            stan_backend='CMDSTANPY',
+            yearly_seasonality=(span_days >= 365),
             weekly_seasonality=True,
             daily_seasonality=False,
-            seasonality_mode='multiplicative'
+            seasonality_mode='multiplicative',
+            uncertainty_samples=100
         )
         model.fit(df)
         
@@ -287,34 +419,69 @@ class ExpensePredictor:
         # Make predictions
         forecast = self.model.predict(future)
         
-        # Format results
-        predictions = []
-        for _, row in forecast.tail(periods).iterrows():
-            predictions.append({
-                'date': row['ds'].strftime('%Y-%m-%d'),
-                'amount': round(max(0, row['yhat']), 2),
-                'lower_bound': round(max(0, row['yhat_lower']), 2),
-                'upper_bound': round(max(0, row['yhat_upper']), 2)
-            })
-        
+        # Format results with vectorized ops instead of per-row iterrows
+        tail = forecast.tail(periods)
+        dates = tail['ds'].dt.strftime('%Y-%m-%d').to_numpy()
+        amounts = np.round(np.maximum(0, tail['yhat'].to_numpy()), 2)
+        lower = np.round(np.maximum(0, tail['yhat_lower'].to_numpy()), 2)
+        upper = np.round(np.maximum(0, tail['yhat_upper'].to_numpy()), 2)
+
+        predictions = [
+            {'date': date, 'amount': amount, 'lower_bound': lo, 'upper_bound': hi}
+            for date, amount, lo, hi in zip(dates, amounts, lower, upper)
+        ]
+
         return predictions
     
     def predict_category_expenses(self, expenses, category_name, periods=30):
         """Predict expenses for a specific category"""
         # Filter expenses by category
         category_expenses = [e for e in expenses if e.category and e.category.name == category_name]
-        
+
         if len(category_expenses) < 15:  # Need reasonable amount of data
             return None
-        
+
+        return self._fit_and_predict_category(category_expenses, category_name, periods)
+
+    def predict_all_category_expenses(self, expenses, periods=30):
+        """Predict expenses for every category with parallel Prophet fits"""
+        # Group expenses by category
+        grouped = {}
+        for expense in expenses:
+            if expense.category and expense.category.name:
+                grouped.setdefault(expense.category.name, []).append(expense)
+
+        # Need reasonable amount of data per category
+        grouped = {name: exps for name, exps in grouped.items() if len(exps) >= 15}
+
+        if not grouped:
+            return {}
+
+        # Prophet fits run in the Stan backend outside the GIL, so loky
+        # workers scale near-linearly across categories
+        from joblib import Parallel, delayed
+        results = Parallel(n_jobs=-1, backend='loky')(
+            delayed(self._fit_and_predict_category)(exps, name, periods)
+            for name, exps in grouped.items()
+        )
+
+        return {name: predictions for name, predictions in zip(grouped, results)
+                if predictions is not None}
+
+    def _fit_and_predict_category(self, category_expenses, category_name, periods):
+        """Fit a category-specific Prophet model and format its forecast"""
         # Prepare data
         df = self.prepare_data(category_expenses)
-        
-        # Train category-specific model
+
+        # Train category-specific model (same fast-fit settings as train_model)
+        span_days = (df['ds'].max() - df['ds'].min()).days
+
         model = Prophet(
-            yearly_seasonality=True,
+            stan_backend='CMDSTANPY',
+            yearly_seasonality=(span_days >= 365),
             weekly_seasonality=True,
-            daily_seasonality=False
+            daily_seasonality=False,
+            uncertainty_samples=100
         )
         model.fit(df)
         
@@ -324,15 +491,16 @@ class ExpensePredictor:
         # Make predictions
         forecast = model.predict(future)
         
-        # Format results
-        predictions = []
-        for _, row in forecast.tail(periods).iterrows():
-            predictions.append({
-                'date': row['ds'].strftime('%Y-%m-%d'),
-                'amount': round(max(0, row['yhat']), 2),
-                'category': category_name
-            })
-        
+        # Format results with vectorized ops instead of per-row iterrows
+        tail = forecast.tail(periods)
+        dates = tail['ds'].dt.strftime('%Y-%m-%d').to_numpy()
+        amounts = np.round(np.maximum(0, tail['yhat'].to_numpy()), 2)
+
+        predictions = [
+            {'date': date, 'amount': amount, 'category': category_name}
+            for date, amount in zip(dates, amounts)
+        ]
+
         return predictions
 
 
@@ -340,9 +508,19 @@ class ExpensePredictor:
 class BudgetRecommender:
     """AI-driven budget recommendations based on spending patterns"""
     
+    _predictor = None
+
     def __init__(self):
         self.kmeans_model = None
         self.scaler = None
+        self.category_index = None
+
+    @classmethod
+    def _get_predictor(cls):
+        """Shared ExpensePredictor - avoids reloading the pickled model per call"""
+        if cls._predictor is None:
+            cls._predictor = ExpensePredictor()
+        return cls._predictor
     
     def analyze_spending_patterns(self, user_id, months=3):
         """Analyze user's spending patterns"""
@@ -364,18 +542,14 @@ class BudgetRecommender:
         if not expenses:
             return None
         
-        # Convert to DataFrame
-        data = []
-        for expense in expenses:
-            data.append({
-                'date': expense.date,
-                'amount': expense.amount,
-                'category': expense.category.name if expense.category else 'Uncategorized',
-                'merchant': expense.merchant
-            })
-        
-        df = pd.DataFrame(data)
-        
+        # Convert to DataFrame (columnar construction, as in prepare_data)
+        df = pd.DataFrame({
+            'date': [e.date for e in expenses],
+            'amount': [e.amount for e in expenses],
+            'category': [e.category.name if e.category else 'Uncategorized' for e in expenses],
+            'merchant': [e.merchant for e in expenses]
+        })
+
         # Aggregate spending by category
         category_spending = df.groupby('category')['amount'].sum().reset_index()
         
@@ -392,68 +566,67 @@ class BudgetRecommender:
         if len(all_user_expenses) < 5:  # Need enough users to cluster
             return None
         
-        # Prepare features for clustering
-        features = []
+        # Build one sparse user x category spending matrix in a single pass
+        # instead of a DataFrame + groupby per user; this also keeps every
+        # user's feature vector aligned to the same category columns
+        from scipy.sparse import coo_matrix
+
+        cat_to_idx = {}
+        rows = []
+        cols = []
+        vals = []
         user_ids = []
-        
+
         for user_id, expenses in all_user_expenses.items():
-            # Convert to DataFrame
-            data = []
-            for expense in expenses:
-                data.append({
-                    'amount': expense.amount,
-                    'category': expense.category.name if expense.category else 'Uncategorized'
-                })
-            
-            df = pd.DataFrame(data)
-            
             # Skip users with no expenses
-            if df.empty:
+            if not expenses:
                 continue
-            
-            # Aggregate by category
-            category_totals = df.groupby('category')['amount'].sum()
-            
-            # Create feature vector (spending by category)
-            feature_vector = []
-            for category in sorted(set(df['category'].unique())):
-                if category in category_totals:
-                    feature_vector.append(category_totals[category])
-                else:
-                    feature_vector.append(0)
-            
-            # Normalize by total spending
-            total_spending = sum(feature_vector)
-            if total_spending > 0:
-                feature_vector = [x / total_spending for x in feature_vector]
-            
-            features.append(feature_vector)
+
+            user_idx = len(user_ids)
             user_ids.append(user_id)
-        
-        if not features:
+
+            for expense in expenses:
+                category = expense.category.name if expense.category else 'Uncategorized'
+                rows.append(user_idx)
+                cols.append(cat_to_idx.setdefault(category, len(cat_to_idx)))
+                vals.append(expense.amount)
+
+        if not user_ids:
             return None
+
+        matrix = coo_matrix((vals, (rows, cols)),
+                            shape=(len(user_ids), len(cat_to_idx))).tocsr()
+
+        # Normalize each row by the user's total spending in one vectorized divide
+        totals = np.asarray(matrix.sum(axis=1)).ravel()
+        features = matrix.multiply(1.0 / np.where(totals > 0, totals, 1)[:, None]).toarray()
+
+        # Remember the category order so single-user vectors can be aligned later
+        self.category_index = cat_to_idx
         
         # Standardize features
         self.scaler = StandardScaler()
         scaled_features = self.scaler.fit_transform(features)
         
-        # Determine optimal number of clusters
-        from sklearn.metrics import silhouette_score
-        
-        silhouette_scores = []
+        # Determine optimal number of clusters - MiniBatchKMeans with a single
+        # init plus the Calinski-Harabasz score avoids the O(N^2) silhouette
+        # computation and the full KMeans fit per candidate k
+        from sklearn.metrics import calinski_harabasz_score
+
+        ch_scores = []
         max_clusters = min(len(scaled_features) - 1, 10)
-        
+
         for k in range(2, max_clusters + 1):
-            kmeans = KMeans(n_clusters=k, random_state=42)
+            kmeans = MiniBatchKMeans(n_clusters=k, batch_size=256, n_init=1, random_state=42)
             cluster_labels = kmeans.fit_predict(scaled_features)
-            silhouette_avg = silhouette_score(scaled_features, cluster_labels)
-            silhouette_scores.append(silhouette_avg)
-        
+            ch_scores.append(calinski_harabasz_score(scaled_features, cluster_labels))
+
         # Choose optimal number of clusters
-        optimal_clusters = silhouette_scores.index(max(silhouette_scores)) + 2
-        
+        optimal_clusters = ch_scores.index(max(ch_scores)) + 2
+
         # Perform clustering
-        self.kmeans_model = KMeans(n_clusters=optimal_clusters, random_state=42)
+        self.kmeans_model = MiniBatchKMeans(n_clusters=optimal_clusters, batch_size=256,
+                                            random_state=42)
         clusters = self.kmeans_model.fit_predict(scaled_features)
         
         # Map users to clusters
@@ -471,17 +644,19 @@ class BudgetRecommender:
         if user_spending is None:
             return None
         
-        # Get expense prediction for next month
-        predictor = ExpensePredictor()
-        user = User.query.get(user_id)
+        # Fetch the user's expenses once - both the fallback average and the
+        # cluster feature vector below read from the same rows
+        user_expenses = Expense.query.filter_by(user_id=user_id).all()
+
+        # Get expense prediction for next month (shared predictor instance)
+        predictor = self._get_predictor()
         future_expenses = predictor.predict_future_expenses(periods=30)
-        
+
         if future_expenses:
             predicted_monthly_total = sum(expense['amount'] for expense in future_expenses)
         else:
             # Fallback: use average of last 3 months
-            expenses = Expense.query.filter_by(user_id=user_id).all()
-            df = pd.DataFrame([{'date': e.date, 'amount': e.amount} for e in expenses])
+            df = pd.DataFrame([{'date': e.date, 'amount': e.amount} for e in user_expenses])
             monthly_totals = df.set_index('date').resample('M')['amount'].sum()
             predicted_monthly_total = monthly_totals.mean() if not monthly_totals.empty else 0
         
@@ -489,22 +664,20 @@ class BudgetRecommender:
         recommendations = []
         
         # Get typical allocations from similar users if available
-        if similar_users and self.kmeans_model:
+        if similar_users and self.kmeans_model and self.category_index:
             # Find user's cluster
-            expenses = Expense.query.filter_by(user_id=user_id).all()
-            data = [{'amount': e.amount, 'category': e.category.name if e.category else 'Uncategorized'} 
-                   for e in expenses]
+            data = [{'amount': e.amount, 'category': e.category.name if e.category else 'Uncategorized'}
+                   for e in user_expenses]
             df = pd.DataFrame(data)
             
-            # Create feature vector for user
+            # Create feature vector for user, aligned to the clustering columns
             category_totals = df.groupby('category')['amount'].sum() if not df.empty else pd.Series()
-            feature_vector = []
-            for category in sorted(set(df['category'].unique())):
-                if category in category_totals:
-                    feature_vector.append(category_totals[category])
-                else:
-                    feature_vector.append(0)
-            
+            feature_vector = [0.0] * len(self.category_index)
+            for category, amount in category_totals.items():
+                idx = self.category_index.get(category)
+                if idx is not None:
+                    feature_vector[idx] = amount
+
             # Normalize
             total_spending = sum(feature_vector)
             if total_spending > 0:
@@ -518,12 +691,31 @@ class BudgetRecommender:
             cluster_users = [u_id for u_id, cluster in similar_users.items() 
                            if cluster == user_cluster and u_id != user_id]
             
-            # Collect spending patterns of similar users
+            # Collect spending patterns of similar users with one IN query
+            # instead of one query (and DataFrame build) per user
             similar_spending = []
-            for similar_user_id in cluster_users:
-                similar_pattern = self.analyze_spending_patterns(similar_user_id)
-                if similar_pattern is not None:
-                    similar_spending.append(similar_pattern)
+            if cluster_users:
+                end_date = datetime.now()
+                start_date = end_date - timedelta(days=90)
+
+                similar_rows = Expense.query.filter(
+                    Expense.user_id.in_(cluster_users),
+                    Expense.date >= start_date,
+                    Expense.date <= end_date
+                ).all()
+
+                if similar_rows:
+                    similar_df = pd.DataFrame([{
+                        'user_id': e.user_id,
+                        'amount': e.amount,
+                        'category': e.category.name if e.category else 'Uncategorized'
+                    } for e in similar_rows])
+
+                    for _, user_df in similar_df.groupby('user_id'):
+                        category_spending = user_df.groupby('category')['amount'].sum().reset_index()
+                        category_spending['percentage'] = \
+                            category_spending['amount'] / user_df['amount'].sum() * 100
+                        similar_spending.append(category_spending)
             
             # Generate recommendations based on similar users' patterns
             if similar_spending:
@@ -607,19 +799,61 @@ class MLEmailParser:
             self.device = torch.device("cuda")
         else:
             self.device = torch.device("cpu")
-            
+
+        self.ner_pipeline = None
+
         if os.path.exists(self.model_path):
             self.ner_model = torch.load(self.model_path, map_location=self.device)
         else:
+            # Prefer an ONNX Runtime export on CPU - much faster than the
+            # PyTorch FP32 path thanks to fused kernels
+            if self.device.type == 'cpu' and os.path.isdir(NER_ONNX_PATH):
+                try:
+                    from optimum.onnxruntime import ORTModelForTokenClassification
+                    from transformers import AutoTokenizer
+
+                    self.tokenizer = AutoTokenizer.from_pretrained(NER_ONNX_PATH)
+                    self.ner_model = ORTModelForTokenClassification.from_pretrained(
+                        NER_ONNX_PATH, provider="CPUExecutionProvider"
+                    )
+                    self.ner_pipeline = pipeline(
+                        "ner",
+                        model=self.ner_model,
+                        tokenizer=self.tokenizer,
+                        batch_size=16
+                    )
+                    return
+                except Exception as e:
+                    print(f"Error loading ONNX NER model, falling back to PyTorch: {e}")
+
             # Initialize with pre-trained transformer model
             try:
                 from transformers import AutoModelForTokenClassification, AutoTokenizer
-                
+
                 # Use a pre-trained NER model
                 model_name = "dbmdz/bert-large-cased-finetuned-conll03-english"
                 self.tokenizer = AutoTokenizer.from_pretrained(model_name)
                 self.ner_model = AutoModelForTokenClassification.from_pretrained(model_name)
                 self.ner_model.to(self.device)
+
+                if self.device.type == 'cuda':
+                    # FP16 roughly doubles throughput on tensor cores
+                    self.ner_model = self.ner_model.half()
+                else:
+                    # Dynamic INT8 quantization of the linear layers for CPU
+                    self.ner_model = torch.quantization.quantize_dynamic(
+                        self.ner_model, {nn.Linear}, dtype=torch.qint8
+                    )
+
+                # Build the pipeline once - constructing it per call rebuilds
+                # the tokenizer and re-moves weights every time
+                self.ner_pipeline = pipeline(
+                    "ner",
+                    model=self.ner_model,
+                    tokenizer=self.tokenizer,
+                    device=0 if self.device.type == 'cuda' else -1,
+                    batch_size=16
+                )
             except Exception as e:
                 print(f"Error initializing transformer model: {e}")
                 self.ner_model = None
@@ -678,14 +912,12 @@ class MLEmailParser:
     
     def extract_with_transformers(self, email_text, email_subject=""):
         """Extract entities using transformers model"""
+        if not self.ner_pipeline:
+            return None
+
         try:
-            from transformers import pipeline
-            
-            # Use NER pipeline
-            ner = pipeline("ner", model=self.ner_model, tokenizer=self.tokenizer, device=0 if torch.cuda.is_available() else -1)
-            
-            # Process text
-            ner_results = ner(email_text)
+            # Process text with the pipeline built in __init__
+            ner_results = self.ner_pipeline(email_text)
             
             # Extract relevant entities
             amounts = []
@@ -750,32 +982,24 @@ class MLEmailParser:
     
     def extract_merchant_from_subject(self, subject):
         """Extract merchant name from email subject"""
-        if not subject:
+        if not subject or len(subject) < 4:
             return None
-            
-        # Use NLP to extract organization
-        doc = nlp(subject)
-        
+
+        # Cheap regex heuristics first - they cover the common
+        # "Order Confirmation from X" subjects without a pipeline pass
+        for pattern in _SUBJECT_MERCHANT_RES:
+            match = pattern.search(subject)
+            if match:
+                return match.group(1).strip()
+
+        # Only run NER when no pattern matched
+        doc = nlp_ner(subject)
+
         # Look for organizations
         orgs = [ent.text for ent in doc.ents if ent.label_ == "ORG"]
         if orgs:
             return orgs[0]
         
-        # Fallback: use heuristics
-        # Common patterns in subjects
-        import re
-        patterns = [
-            r'(?:Receipt|Order|Confirmation) from ([\w\s&]+)',
-            r'([\w\s&]+) Order Confirmation',
-            r'Your ([\w\s&]+) order',
-            r'Thanks for your ([\w\s&]+) order'
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, subject, re.IGNORECASE)
-            if match:
-                return match.group(1).strip()
-        
         # Last resort: use the first part of the subject
         words = subject.split()
         if words:
@@ -5,16 +5,27 @@ from sqlalchemy.orm import Session
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from typing import Optional
+import hmac
 import os
 
 from .database import get_db
 from . import models
 
-# Setup
-SECRET_KEY = os.getenv("SECRET_KEY", "devsecretkeyneedtochange")
+# Setup - fail closed: refusing to boot without a real secret beats silently
+# signing tokens with a well-known dev fallback
+SECRET_KEY = os.getenv("SECRET_KEY")
+if not SECRET_KEY:
+    raise RuntimeError("SECRET_KEY environment variable must be set")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 hours
 
+def constant_time_compare(a: str, b: str) -> bool:
+    """Compare secret material without leaking timing information.
+
+    Use this instead of == for any comparison involving tokens or API keys.
+    """
+    return hmac.compare_digest(a.encode("utf-8"), b.encode("utf-8"))
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/token")
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
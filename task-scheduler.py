@@ -1,41 +1,98 @@
 # app/task_scheduler.py
+import functools
 import os
+import sys
 import base64
+import re
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from types import SimpleNamespace
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from bs4 import BeautifulSoup
+from sqlalchemy import func, insert, select, update
 from sqlalchemy.orm import Session
 import asyncio
 import logging
+import dateutil.parser
 
 from app.database import get_db_context
 from app.models import User, Expense, Category
 from app.ai.email_parser_ml import MLEmailParser
 from app.ai.nlp_processor import ExpenseNLPProcessor
 
+# selectolax (C-backed Lexbor parser) converts HTML to text much faster than
+# BeautifulSoup; fall back to BeautifulSoup with the lxml parser when missing
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# The parse step (base64 decode, HTML strip, model inference) is CPU-bound,
+# so it fans out across cores; parser singletons initialize lazily inside
+# each pool worker
+_PARSE_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+
 # Gmail API scopes
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
+# Subjects worth a full payload download - mirrors the keywords in the
+# Gmail search query, re-checked because the query also matches thread
+# replies whose own subject is unrelated
+_RECEIPT_SUBJECT_RE = re.compile(
+    r'receipt|order|invoice|purchase|confirmation', re.IGNORECASE)
+
+# Constructing these loads models/vocab, so share one instance per process.
+# Lazy lru_cache factories keep import (and scheduler start-up) cheap.
+@functools.lru_cache(maxsize=None)
+def _get_email_parser():
+    return MLEmailParser()
+
+@functools.lru_cache(maxsize=None)
+def _get_nlp_processor():
+    return ExpenseNLPProcessor()
+
+@functools.lru_cache(maxsize=4096)
+def _predict_category(merchant_lc, desc_sig):
+    """Predict a category from normalized merchant/description text.
+
+    A user's receipts are dominated by a handful of recurring merchants,
+    so caching on the normalized key skips most model inference.
+    """
+    return _get_nlp_processor().predict_category(
+        SimpleNamespace(merchant=merchant_lc, description=desc_sig))
+
+@functools.lru_cache(maxsize=1024)
+def _build_service(refresh_token):
+    """Build a Gmail API service, memoized per refresh token.
+
+    build() parses the discovery document and constructs dozens of
+    resource classes on every call; static_discovery uses the bundled
+    document so no network fetch is involved either.
+    """
+    creds = Credentials.from_authorized_user_info(
+        {
+            'refresh_token': refresh_token,
+            'client_id': os.environ.get('GOOGLE_CLIENT_ID'),
+            'client_secret': os.environ.get('GOOGLE_CLIENT_SECRET'),
+            'token_uri': 'https://oauth2.googleapis.com/token',
+            'scopes': SCOPES
+        }
+    )
+
+    return build('gmail', 'v1', credentials=creds,
+                 cache_discovery=False, static_discovery=True)
+
 def get_gmail_service(refresh_token):
     """Create a Gmail API service using the user's refresh token"""
     try:
-        creds = Credentials.from_authorized_user_info(
-            {
-                'refresh_token': refresh_token,
-                'client_id': os.environ.get('GOOGLE_CLIENT_ID'),
-                'client_secret': os.environ.get('GOOGLE_CLIENT_SECRET'),
-                'token_uri': 'https://oauth2.googleapis.com/token',
-                'scopes': SCOPES
-            }
-        )
-        
-        return build('gmail', 'v1', credentials=creds)
+        return _build_service(refresh_token)
     except Exception as e:
         logger.error(f"Error creating Gmail service: {e}")
         return None
@@ -43,173 +100,321 @@ def get_gmail_service(refresh_token):
 async def schedule_email_fetch(db_getter):
     """Schedule email fetching for all users"""
     logger.info("Starting scheduled email fetch for all users")
-    
+
+    # Read the ids up front and release the session - the fetch tasks must
+    # not outlive it the way the old fire-and-forget create_task calls did
     db = next(db_getter())
     try:
-        users = db.query(User).all()
-        
-        for user in users:
-            # Use asyncio to run tasks in parallel
-            asyncio.create_task(fetch_emails(user.id))
-        
-        logger.info(f"Scheduled email fetch for {len(users)} users")
+        # Column-only select - no point hydrating User instances (and their
+        # lazy relationships) to read a few attributes
+        user_rows = db.execute(
+            select(User.id, User.refresh_token, User.last_history_id)).all()
     except Exception as e:
         logger.error(f"Error scheduling email fetch: {e}")
+        return
     finally:
         db.close()
 
-async def fetch_emails(user_id: int):
-    """Fetch and process emails for a user"""
+    # Build the search query once per tick rather than per user - every
+    # user then shares the same after: boundary for this cycle
+    seven_days_ago = (datetime.now() - timedelta(days=7)).strftime('%Y/%m/%d')
+    query = f'subject:(receipt OR order OR invoice OR purchase OR confirmation) after:{seven_days_ago}'
+
+    # Bounded concurrency: overlap the users' network waits without
+    # hammering Gmail's per-user quota, and actually wait for completion
+    semaphore = asyncio.Semaphore(16)
+
+    async def _fetch_one(user_id, refresh_token, last_history_id):
+        async with semaphore:
+            await fetch_emails(user_id, refresh_token, query, last_history_id)
+
+    await asyncio.gather(
+        *(_fetch_one(row.id, row.refresh_token, row.last_history_id)
+          for row in user_rows),
+        return_exceptions=True)
+
+    logger.info(f"Completed email fetch for {len(user_rows)} users")
+
+def _list_new_message_ids(service, query, last_history_id):
+    """List candidate message ids, incrementally when a checkpoint exists.
+
+    With a stored history id, users.history.list returns only mail that
+    arrived since the previous cycle. Without one (or when the checkpoint
+    has expired server-side) fall back to the full search query; the
+    caller bootstraps a fresh checkpoint from the fetched messages.
+    Returns (ids, new_history_id) where new_history_id is None on the
+    fallback path.
+    """
+    if last_history_id:
+        try:
+            ids = []
+            new_history_id = last_history_id
+            page_token = None
+            while True:
+                history = service.users().history().list(
+                    userId='me', startHistoryId=last_history_id,
+                    historyTypes=['messageAdded'], pageToken=page_token).execute()
+                new_history_id = history.get('historyId', new_history_id)
+                for record in history.get('history', []):
+                    for added in record.get('messagesAdded', []):
+                        ids.append(added['message']['id'])
+                page_token = history.get('nextPageToken')
+                if not page_token:
+                    return ids, new_history_id
+        except Exception as e:
+            # Gmail answers an expired startHistoryId with a 404
+            logger.warning(f"History sync failed ({e}), falling back to full listing")
+
+    results = service.users().messages().list(userId='me', q=query).execute()
+    messages = results.get('messages', [])
+
+    return [message['id'] for message in messages], None
+
+async def fetch_emails(user_id: int, refresh_token: str, query: str,
+                       last_history_id: str = None):
+    """Fetch and process emails for a user matching a Gmail search query"""
     logger.info(f"Fetching emails for user {user_id}")
-    
+
     with get_db_context() as db:
-        user = db.query(User).filter(User.id == user_id).first()
-        
-        if not user:
-            logger.error(f"User {user_id} not found")
-            return
-        
-        service = get_gmail_service(user.refresh_token)
-        
+        # The scheduler already passed the refresh token in, so there is no
+        # per-user SELECT here. Blocking Gmail and SQLAlchemy calls run via
+        # asyncio.to_thread so the event loop can overlap users' fetches.
+        service = get_gmail_service(refresh_token)
+
         if not service:
             logger.error(f"Could not create Gmail service for user {user_id}")
             return
         
-        # Search for purchase-related emails (last 7 days)
-        seven_days_ago = (datetime.now() - timedelta(days=7)).strftime('%Y/%m/%d')
-        query = f'subject:(receipt OR order OR invoice OR purchase OR confirmation) after:{seven_days_ago}'
-        
         try:
-            results = service.users().messages().list(userId='me', q=query).execute()
-            messages = results.get('messages', [])
-            
-            logger.info(f"Found {len(messages)} potential purchase emails for user {user_id}")
-            
-            # Process each email
-            for message in messages:
-                await process_email(db, user, service, message['id'])
-                
-            logger.info(f"Email fetch completed for user {user_id}")
+            # Incremental when possible: only ids that appeared since the
+            # stored history checkpoint, not seven days' worth of mail
+            ids, new_history_id = await asyncio.to_thread(
+                _list_new_message_ids, service, query, last_history_id)
+
+            logger.info(f"Found {len(ids)} potential purchase emails for user {user_id}")
+
+            # Drop already-processed ids with one IN query before paying for
+            # the batch download - steady-state polling mostly re-sees mail
+            if ids:
+                existing = await asyncio.to_thread(
+                    lambda: {row.email_id for row in db.execute(
+                        select(Expense.email_id).where(
+                            Expense.user_id == user_id,
+                            Expense.email_id.in_(ids)))})
+                ids = [message_id for message_id in ids if message_id not in existing]
+
+            # Metadata-only first pass - headers are a few hundred bytes
+            # versus 100KB+ for a full payload, so rejected candidates
+            # never pay the wire cost of the full fetch
+            meta = await asyncio.to_thread(
+                fetch_email_batch, service, ids, 'metadata', ('Subject', 'Date', 'From'))
+
+            # Bootstrap the checkpoint on the fallback path from the newest
+            # listed message so the next cycle can sync incrementally
+            if new_history_id is None and meta:
+                new_history_id = max(
+                    (m.get('historyId') for m in meta.values() if m.get('historyId')),
+                    key=int, default=None)
+
+            candidates = []
+            for message_id, message in meta.items():
+                meta_headers = message.get('payload', {}).get('headers', [])
+                meta_subject = next(
+                    (h['value'] for h in meta_headers if h['name'].lower() == 'subject'), '')
+                if _RECEIPT_SUBJECT_RE.search(meta_subject):
+                    candidates.append(message_id)
+
+            fetched = await asyncio.to_thread(fetch_email_batch, service, candidates)
+
+            # Process in chunks of 32 under gather - the pooled parses and
+            # categorization lookups overlap instead of being awaited one
+            # by one; all writes still funnel through this single session
+            expense_rows = []
+            payloads = list(fetched.values())
+            for start in range(0, len(payloads), 32):
+                chunk_rows = await asyncio.gather(
+                    *(process_email_payload(db, user_id, message)
+                      for message in payloads[start:start + 32]))
+                expense_rows.extend(row for row in chunk_rows if row)
+
+            # One executemany INSERT and one COMMIT per fetch cycle instead
+            # of an INSERT+COMMIT round-trip per email; categories created
+            # during categorization land in the same transaction
+            def _persist():
+                if expense_rows:
+                    db.execute(insert(Expense), expense_rows)
+                if new_history_id:
+                    # Advance the checkpoint in the same transaction as the
+                    # inserts so a crash cannot skip unprocessed mail
+                    db.execute(update(User).where(User.id == user_id)
+                               .values(last_history_id=str(new_history_id)))
+                db.commit()
+
+            if expense_rows or new_history_id:
+                await asyncio.to_thread(_persist)
+
+            logger.info(f"Email fetch completed for user {user_id}: {len(expense_rows)} expenses")
         except Exception as e:
             logger.error(f"Error fetching emails for user {user_id}: {e}")
 
-async def process_email(db: Session, user: User, service, message_id: str):
-    """Process a single email to extract expense information"""
-    logger.info(f"Processing email {message_id} for user {user.id}")
-    
-    # Check if this email has already been processed
-    existing_expense = db.query(Expense).filter(Expense.email_id == message_id).first()
-    if existing_expense:
-        logger.info(f"Email {message_id} already processed, skipping")
-        return
-    
+def fetch_email_batch(service, ids, fmt='full', metadata_headers=None):
+    """Fetch message payloads via Gmail's batch endpoint.
+
+    One multipart HTTP request covers up to 100 messages, instead of a
+    round-trip per message. Returns a dict keyed by message id.
+    """
+    fetched = {}
+
+    def _collect(request_id, response, exception):
+        if exception is None:
+            fetched[response['id']] = response
+        else:
+            logger.error(f"Error fetching message in batch: {exception}")
+
+    for start in range(0, len(ids), 100):
+        batch = service.new_batch_http_request(callback=_collect)
+        for message_id in ids[start:start + 100]:
+            kwargs = {'userId': 'me', 'id': message_id, 'format': fmt}
+            if metadata_headers:
+                kwargs['metadataHeaders'] = list(metadata_headers)
+            batch.add(service.users().messages().get(**kwargs))
+        batch.execute()
+
+    return fetched
+
+async def process_email_payload(db: Session, user_id: int, message):
+    """Process an already-downloaded email message into an expense"""
+    message_id = message['id']
+    logger.info(f"Processing email {message_id} for user {user_id}")
+
     try:
-        # Get the email message
-        message = service.users().messages().get(userId='me', id=message_id, format='full').execute()
-        
         # Extract email details
         payload = message['payload']
         headers = payload['headers']
-        
-        # Get subject
-        subject = next((header['value'] for header in headers if header['name'].lower() == 'subject'), '')
-        
-        # Get date
-        date_str = next((header['value'] for header in headers if header['name'].lower() == 'date'), '')
+
+        # One pass over the headers instead of a full scan per lookup -
+        # Gmail payloads routinely carry dozens of headers. Interning the
+        # lowered names dedupes the small recurring set of header strings
+        # across messages and makes the dict probes pointer comparisons
+        # (the 'subject'/'date' literals below are interned by CPython).
+        hdr = {sys.intern(header['name'].lower()): header['value'] for header in headers}
+        subject = hdr.get('subject', '')
+        date_str = hdr.get('date', '')
+
         try:
-            import dateutil.parser
             date = dateutil.parser.parse(date_str).date()
         except:
             date = datetime.now().date()
         
-        # Extract email body
-        email_text = extract_email_body(payload)
-        
-        # Use ML email parser
-        email_parser = MLEmailParser()
-        results = email_parser.extract_expense_details(email_text, subject)
+        # Body extraction and ML parsing run in the process pool so the
+        # event loop stays free and multiple emails parse in parallel
+        loop = asyncio.get_event_loop()
+        results = await loop.run_in_executor(_PARSE_POOL, _parse_email, payload, subject)
         
         if results and 'amount' in results and 'merchant' in results:
-            # Create expense record
+            # Build the expense (not yet persisted - the caller inserts the
+            # whole fetch cycle in one executemany statement)
             expense = Expense(
                 date=results.get('date', date),
                 amount=results['amount'],
                 merchant=results['merchant'],
                 description=results.get('description', ''),
-                user_id=user.id,
+                user_id=user_id,
                 email_id=message_id
             )
-            
+
             # Try to categorize expense
-            await categorize_expense(db, expense, user.id)
-            
-            db.add(expense)
-            db.commit()
-            
-            logger.info(f"Created expense from email {message_id}: {expense.merchant} ${expense.amount}")
-            
+            await categorize_expense(db, expense, user_id)
+
+            logger.info(f"Parsed expense from email {message_id}: {expense.merchant} ${expense.amount}")
+
             # Notify connected clients about new expense
             # This would integrate with the WebSocket manager
-            # await notify_new_expense(user.id, expense)
+            # await notify_new_expense(user_id, expense)
+
+            return {
+                'date': expense.date,
+                'amount': expense.amount,
+                'merchant': expense.merchant,
+                'description': expense.description,
+                'category_id': expense.category_id,
+                'user_id': user_id,
+                'email_id': message_id
+            }
         else:
             logger.info(f"Could not extract expense details from email {message_id}")
-    
+
     except Exception as e:
         logger.error(f"Error processing email {message_id}: {e}")
-        db.rollback()
+
+    return None
+
+def _parse_email(payload, subject):
+    """Extract body text and expense details from a message payload.
+
+    Pure CPU work with no database or network access, so it is safe to
+    run in a process pool worker.
+    """
+    email_text = extract_email_body(payload)
+
+    return _get_email_parser().extract_expense_details(email_text, subject)
+
+def _html_to_text(html):
+    """Convert HTML email markup to plain text"""
+    if HTMLParser is not None:
+        return HTMLParser(html).text(separator=' ')
+
+    return BeautifulSoup(html, 'lxml').get_text(separator=' ', strip=True)
 
 def extract_email_body(payload):
     """Extract email body from Gmail API payload"""
-    text = ""
-    
-    if 'parts' in payload:
-        parts = payload['parts']
-        
-        # First try to get plain text
-        for part in parts:
-            if part['mimeType'] == 'text/plain':
-                data = part['body'].get('data', '')
-                if data:
-                    text = base64.urlsafe_b64decode(data).decode('utf-8')
-                    break
-        
-        # If no plain text, try HTML
-        if not text:
-            for part in parts:
-                if part['mimeType'] == 'text/html':
-                    data = part['body'].get('data', '')
-                    if data:
-                        html = base64.urlsafe_b64decode(data).decode('utf-8')
-                        # Convert HTML to plain text
-                        from bs4 import BeautifulSoup
-                        soup = BeautifulSoup(html, 'html.parser')
-                        text = soup.get_text(separator=' ', strip=True)
-                        break
-    else:
-        # Single part message
-        data = payload['body'].get('data', '')
-        if data:
-            text = base64.urlsafe_b64decode(data).decode('utf-8')
-    
-    return text
+    # Single recursive walk over the MIME tree - the old double scan only
+    # looked at the top-level parts, so multipart/alternative and
+    # multipart/related emails came back empty
+    mimes = {}
+
+    def _walk(part):
+        if 'parts' in part:
+            for sub_part in part['parts']:
+                _walk(sub_part)
+        else:
+            mime = part.get('mimeType', '')
+            data = part.get('body', {}).get('data', '')
+            if data and mime not in mimes:
+                mimes[mime] = data
+
+    _walk(payload)
+
+    # Prefer plain text; only pay for HTML stripping when there is no choice
+    data = mimes.get('text/plain')
+    if data:
+        return base64.urlsafe_b64decode(data).decode('utf-8')
+
+    data = mimes.get('text/html')
+    if data:
+        return _html_to_text(base64.urlsafe_b64decode(data).decode('utf-8'))
+
+    return ""
 
 async def categorize_expense(db: Session, expense: Expense, user_id: int):
     """Categorize an expense using NLP"""
-    # Initialize NLP processor
-    nlp_processor = ExpenseNLPProcessor()
-    
-    # Predict category
-    category_name = nlp_processor.predict_category(expense)
+    # Predict category through the memoized helper - normalize the key so
+    # case/whitespace variants of the same merchant share a cache entry
+    merchant_lc = (expense.merchant or '').lower().strip()
+    desc_sig = (expense.description or '')[:64].lower()
+    category_name = _predict_category(merchant_lc, desc_sig)
     
     if category_name:
-        # Look up category by name
-        category = db.query(Category).filter(
-            Category.name.ilike(category_name),
-            Category.user_id == user_id
-        ).first()
-        
-        if category:
-            expense.category_id = category.id
+        # Column-only lookup - a single id read needs no ORM instance.
+        # lower(name) = lower(:x) instead of ILIKE lets Postgres use an
+        # index on (user_id, lower(name)) rather than seq-scanning.
+        category_id = db.execute(
+            select(Category.id).where(
+                func.lower(Category.name) == category_name.lower(),
+                Category.user_id == user_id)).scalar()
+
+        if category_id:
+            expense.category_id = category_id
         else:
             # Create new category if it doesn't exist
             new_category = Category(name=category_name, user_id=user_id)
@@ -1,46 +1,68 @@
 # app/websocket.py
+import asyncio
+
 from fastapi import WebSocket
-from typing import Dict, List, Any
-import json
+from typing import Dict, Set, Any
+import orjson
 
 class ConnectionManager:
     """Manager for WebSocket connections"""
-    
+
     def __init__(self):
-        # Store connections by user ID
-        self.active_connections: Dict[int, List[WebSocket]] = {}
-    
+        # Store connections by user ID - sets make disconnect O(1), which
+        # matters during reconnect storms from multi-tab users
+        self.active_connections: Dict[int, Set[WebSocket]] = {}
+
     async def connect(self, websocket: WebSocket, user_id: int):
         """Connect a new WebSocket for a user"""
         await websocket.accept()
-        
-        if user_id not in self.active_connections:
-            self.active_connections[user_id] = []
-        
-        self.active_connections[user_id].append(websocket)
-    
+
+        self.active_connections.setdefault(user_id, set()).add(websocket)
+
     def disconnect(self, websocket: WebSocket, user_id: int):
         """Disconnect a WebSocket"""
-        if user_id in self.active_connections:
-            if websocket in self.active_connections[user_id]:
-                self.active_connections[user_id].remove(websocket)
-            
+        connections = self.active_connections.get(user_id)
+
+        if connections is not None:
+            connections.discard(websocket)
+
             # Clean up if no more connections for this user
-            if not self.active_connections[user_id]:
+            if not connections:
                 del self.active_connections[user_id]
-    
+
+    async def _fan_out(self, user_id: int, payload: bytes):
+        """Send an already-serialized payload to all of a user's sockets.
+
+        Sends run concurrently under gather; failed sends mark the socket
+        dead and it is pruned in a single pass afterwards.
+        """
+        connections = list(self.active_connections.get(user_id, ()))
+
+        if not connections:
+            return
+
+        results = await asyncio.gather(
+            *(connection.send_bytes(payload) for connection in connections),
+            return_exceptions=True
+        )
+
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
+                self.disconnect(connection, user_id)
+
     async def send_personal_message(self, message: Dict[str, Any], websocket: WebSocket):
         """Send a message to a specific WebSocket"""
-        await websocket.send_text(json.dumps(message))
-    
+        await websocket.send_bytes(orjson.dumps(message))
+
     async def broadcast_to_user(self, user_id: int, message: Dict[str, Any]):
         """Broadcast a message to all connections for a specific user"""
-        if user_id in self.active_connections:
-            for connection in self.active_connections[user_id]:
-                await connection.send_text(json.dumps(message))
-    
+        await self._fan_out(user_id, orjson.dumps(message))
+
     async def broadcast(self, message: Dict[str, Any]):
         """Broadcast a message to all connections"""
-        for user_connections in self.active_connections.values():
-            for connection in user_connections:
-                await connection.send_text(json.dumps(message))
+        # Serialize once for every recipient instead of once per socket
+        payload = orjson.dumps(message)
+
+        await asyncio.gather(
+            *(self._fan_out(user_id, payload) for user_id in list(self.active_connections))
+        )